@@ -53,6 +53,23 @@ import matplotlib.pyplot as plt
 print("TF version", tf.__version__)
 print("TF Hub Version", hub.__version__)
 
+"""### Loading this machine's tuning profile
+
+The auto-tuner at the bottom of the notebook saves the best batch sizes, prediction image size and number of input pipeline threads for each machine it runs on. If this machine has a profile it's loaded here (before the batch sizes are set), otherwise the defaults are used.
+
+The profile is loaded by `predict_dogs.py` (the batch prediction script, it sits next to this notebook on Drive) so the script and the notebook use the same one.
+"""
+
+import json
+import os
+import socket
+import sys
+
+# make predict_dogs.py importable
+sys.path.append("drive/MyDrive/Dog Breed Identifier")
+from predict_dogs import PROFILES_DIR, HOST_PROFILE
+HOST_PROFILE
+
 # check for GPU availability
 print("GPU", "available :^)" if tf.config.list_physical_devices("GPU") else "not available :^(")
 
@@ -169,24 +186,21 @@ Write a function that:
 # define image size
 IMG_SIZE = 224
 
+# image size for the prediction paths (224 unless this machine's profile says otherwise), training always uses IMG_SIZE
+PREDICT_IMG_SIZE = HOST_PROFILE.get("predict_img_size", IMG_SIZE)
+
 # creat a function for preprocessing images
-def process_image(image_path):
+def process_image(image_path, img_size=IMG_SIZE):
   """
   Takes an image file path an turns it into a tensor.
   """
   # read in an image file
   image = tf.io.read_file(image_path)
 
-  # turn the image inot tensor with 3 color channels
-  image = tf.image.decode_jpeg(image, channels=3)
-
-  # convert the color channel values from 0-255 to 0-1 values 
-  image = tf.image.convert_image_dtype(image, tf.float32)
+  return decode_image(image, img_size)
 
-  # Resize the image to (224, 224)
-  image = tf.image.resize(image, size=[IMG_SIZE, IMG_SIZE])
-
-  return image
+# decoding, normalizing and resizing lives in predict_dogs.py so batch predictions preprocess images exactly the same way
+from predict_dogs import decode_image
 
 """## Turning the data into batches
 
@@ -197,11 +211,11 @@ The data needs to be in Tensor tuples:
 """
 
 # function that returns a tuple of tensors
-def get_image_label(image_path, label):
+def get_image_label(image_path, label, img_size=IMG_SIZE):
   """
   Takes image path name and the associated label, processes the image and returns a tuple of (image, label)
   """
-  image = process_image(image_path)
+  image = process_image(image_path, img_size)
   return image, label
 
 # demo of the above
@@ -209,21 +223,31 @@ def get_image_label(image_path, label):
 
 """Make a function that turns `X` and `y` into batches."""
 
-# defin the batch size, 32 is where I'll start
-BATCH_SIZE = 32
+# defin the batch size, 32 is where I'll start (unless this machine's profile says otherwise)
+BATCH_SIZE = HOST_PROFILE.get("train_batch_size", 32)
+
+# batch size for predicting and number of threads for preparing images, from the profile too
+PREDICT_BATCH_SIZE = HOST_PROFILE.get("predict_batch_size", BATCH_SIZE)
+NUM_PARALLEL_CALLS = HOST_PROFILE.get("num_parallel_calls", None)
 
 # function to turn data into batches
-def create_data_batches(X, y=None, batch_size=BATCH_SIZE, valid_data=False, test_data=False):
+def create_data_batches(X, y=None, batch_size=None, valid_data=False, test_data=False, img_size=IMG_SIZE,
+                        num_parallel_calls=NUM_PARALLEL_CALLS):
   """
   Creates batches of data out of image (X) and label (y) pairs.
   SHuffles the data if it's training data but doesn't shuffle if it's validation data.
   Also accepts test data as input (no labels).
   """
+  # test data is only predicted on so it gets the prediction batch size
+  if batch_size is None:
+    batch_size = PREDICT_BATCH_SIZE if test_data else BATCH_SIZE
+
   # if test dataset, there are no labels
   if test_data:
     print("Creating test data batches")
     data = tf.data.Dataset.from_tensor_slices((tf.constant(X)))
-    data_batch = data.map(process_image).batch(BATCH_SIZE)
+    data_batch = data.map(lambda image_path: process_image(image_path, img_size),
+                          num_parallel_calls=num_parallel_calls).batch(batch_size)
     return data_batch
 
   # If valid data set, don't shuffle it
@@ -231,7 +255,8 @@ def create_data_batches(X, y=None, batch_size=BATCH_SIZE, valid_data=False, test
     print("Creating validation data batches")
     data = tf.data.Dataset.from_tensor_slices((tf.constant(X), 
                                                tf.constant(y)))
-    data_batch = data.map(get_image_label).batch(BATCH_SIZE)
+    data_batch = data.map(lambda image_path, label: get_image_label(image_path, label, img_size),
+                          num_parallel_calls=num_parallel_calls).batch(batch_size)
     return data_batch
   # if training data set, shuffle
   else:
@@ -242,10 +267,11 @@ def create_data_batches(X, y=None, batch_size=BATCH_SIZE, valid_data=False, test
     data = data.shuffle(buffer_size=len(X))
 
     # create (X, y) tuples and turns the image path into preprossed image
-    data = data.map(get_image_label)
+    data = data.map(lambda image_path, label: get_image_label(image_path, label, img_size),
+                    num_parallel_calls=num_parallel_calls)
 
     # turn trining data into batches
-    data_batch = data.batch(BATCH_SIZE)
+    data_batch = data.batch(batch_size)
     return data_batch
 
 # create training and validation data batches
@@ -321,15 +347,15 @@ Steps are from here: https://www.tensorflow.org/guide/keras/sequential_model
 
 # function that creates a Keras model
 def create_model(input_shape=INPUT_SHAPE, output_shape=OUTPUT_SHAPE, model_url=MODEL_URL):
-  print("Building model with:", MODEL_URL)
+  print("Building model with:", model_url)
   """
   Create a function that builds a Keras model in sequential fashion, compiles the model and builds the model. 
   """
 
   #Setup the model layers
   model = tf.keras.Sequential([
-    hub.KerasLayer(MODEL_URL), # layer 1 (input layer)
-    tf.keras.layers.Dense(units=OUTPUT_SHAPE,
+    hub.KerasLayer(model_url), # layer 1 (input layer)
+    tf.keras.layers.Dense(units=output_shape,
                           activation="softmax") # layer 2 (output layer)
   ])
 
@@ -341,7 +367,7 @@ def create_model(input_shape=INPUT_SHAPE, output_shape=OUTPUT_SHAPE, model_url=M
   )
 
   # Build the model
-  model.build(INPUT_SHAPE)
+  model.build(input_shape)
 
   return model
 
@@ -457,11 +483,11 @@ print(f"Max index: {np.argmax(predictions[index])}")
 print(f"Predicted label: {unique_breeds[np.argmax(predictions[index])]}")
 
 # Turn prediction probabilities in their labels
-def get_pred_label(prediction_probabilities):
+def get_pred_label(prediction_probabilities, breeds=unique_breeds):
   """
-  Turns an array of predictions into a label.
+  Turns an array of predictions into a label, using the breeds the model was trained on.
   """
-  return unique_breeds[np.argmax(prediction_probabilities)]
+  return breeds[np.argmax(prediction_probabilities)]
 
 # get a predicted labe based on prediction probabilities
 pred_label = get_pred_label(predictions[99])
@@ -776,3 +802,873 @@ for i, image in enumerate(custom_images):
   plt.title(custom_pred_labels[i])
   plt.imshow(image)
 
+"""## Finding training dogs that look like mine
+
+Show the training dogs that look the most like a dog I made a prediction on.
+
+What to do:
+* Cut the Dense output layer off the trained model so the TF Hub layer (the penultimate layer) outputs an embedding for each image
+* Extract embeddings for the training images and store them in a memory-mapped file
+* Build an approximate nearest neighbour index (HNSW) over the embeddings with `faiss`, if `faiss` isn't installed fall back to NumPy brute force over the memory-mapped file
+* Query the index for the k nearest training images and their breeds
+* Add new images to the index without rebuilding it
+"""
+
+# faiss is optional, without it searches are brute force
+try:
+  import faiss
+except ImportError:
+  faiss = None
+
+import shutil
+import time
+
+# where the embedding index is stored
+INDEX_DIR = "drive/MyDrive/Dog Breed Identifier/embedding_index/"
+
+# function that turns a trained model into an embedding model
+def create_embedding_model(model):
+  """
+  Returns a model that outputs the penultimate layer (the TF Hub layer) of a trained model.
+  """
+  # reuse every layer except the Dense output layer so the weights are shared
+  embedding_model = tf.keras.Sequential(model.layers[:-1])
+  embedding_model.build(INPUT_SHAPE)
+  return embedding_model
+
+# function for normalizing embeddings
+def normalize_embeddings(embeddings):
+  """
+  L2 normalizes an array of embeddings so the inner product is the cosine similarity.
+  """
+  embeddings = np.asarray(embeddings, dtype="float32")
+  return embeddings / (np.linalg.norm(embeddings, axis=1, keepdims=True) + 1e-12)
+
+# function that gets the embeddings of a list of images
+def get_embeddings(embedding_model, image_paths):
+  """
+  Turns a list of image paths into an array of normalized embeddings.
+  """
+  data = create_data_batches(image_paths, test_data=True)
+  return normalize_embeddings(embedding_model.predict(data, verbose=1))
+
+# function for writing a file atomically
+def write_json_atomically(data, path):
+  """
+  Writes JSON to a temporary file and renames it over path, so readers never see half a file.
+  """
+  tmp_path = path + ".tmp"
+  with open(tmp_path, "w") as f:
+    json.dump(data, f)
+  os.replace(tmp_path, path)
+
+# function for opening the memory-mapped embeddings
+def open_embeddings(index):
+  """
+  Opens the embeddings file of an index as a read only memory-mapped array.
+  Only the rows with meta data (the ones index.json counts) are used.
+  """
+  count = len(index["meta"])
+  # numpy can't memory-map an empty file
+  if count == 0:
+    return np.zeros((0, index["dim"]), dtype="float32")
+  embeddings = np.memmap(os.path.join(index["dir"], "embeddings.f32"),
+                         dtype="float32",
+                         mode="r").reshape(-1, index["dim"])
+  if len(embeddings) < count:
+    raise ValueError(f"Embedding index is broken: {len(embeddings)} embeddings for {count} images")
+  return embeddings[:count]
+
+# function for building the HNSW graph from the memory-mapped embeddings
+def rebuild_ann(index):
+  """
+  Builds the HNSW graph of an index from scratch out of its embeddings and saves it.
+  """
+  print(f"Building HNSW graph over {len(index['embeddings'])} embeddings")
+  index["ann"] = faiss.IndexHNSWFlat(index["dim"], 32, faiss.METRIC_INNER_PRODUCT)
+  index["ann"].add(np.ascontiguousarray(index["embeddings"]))
+  save_ann(index)
+
+# function for saving the HNSW graph
+def save_ann(index):
+  """
+  Saves the HNSW graph of an index under a temporary name and renames it into place.
+  """
+  ann_path = os.path.join(index["dir"], "hnsw.faiss")
+  faiss.write_index(index["ann"], ann_path + ".tmp")
+  os.replace(ann_path + ".tmp", ann_path)
+
+# function for adding images to an embedding index
+def add_to_embedding_index(index, image_paths, breeds):
+  """
+  Adds images and their breeds to an embedding index and saves it.
+  """
+  embeddings = get_embeddings(index["embedding_model"], image_paths)
+  index["dim"] = embeddings.shape[1]
+  count = len(index["meta"])
+
+  # append the new embeddings after the last counted row, dropping rows left over by an add that crashed
+  embeddings_path = os.path.join(index["dir"], "embeddings.f32")
+  with open(embeddings_path, "ab") as f:
+    f.truncate(count * index["dim"] * 4)
+    f.write(embeddings.tobytes())
+
+  # write the image paths and breeds in the same order
+  meta_path = os.path.join(index["dir"], "meta.csv")
+  new_meta = pd.DataFrame({"path": list(image_paths), "breed": list(breeds)})
+  meta = pd.concat([index["meta"], new_meta], ignore_index=True)
+  meta.to_csv(meta_path + ".tmp", index=False)
+  os.replace(meta_path + ".tmp", meta_path)
+
+  # the HNSW graph takes new embeddings without being rebuilt
+  if faiss is not None:
+    if index["ann"] is None:
+      index["ann"] = faiss.IndexHNSWFlat(index["dim"], 32, faiss.METRIC_INNER_PRODUCT)
+    index["ann"].add(embeddings)
+    save_ann(index)
+
+  # index.json is written last, its count is what makes the new rows part of the index
+  write_json_atomically({"dim": index["dim"], "count": len(meta)},
+                        os.path.join(index["dir"], "index.json"))
+
+  index["meta"] = meta
+  index["embeddings"] = open_embeddings(index)
+  print(f"Embedding index has {len(index['meta'])} images")
+  return index
+
+# function for building an embedding index from scratch
+def build_embedding_index(model, image_paths, breeds, index_dir=INDEX_DIR):
+  """
+  Builds a new embedding index out of images and their breeds using a trained model.
+  The index is built in a temporary directory and swapped in at the end, so the old index is kept if it fails.
+  """
+  index_dir = index_dir.rstrip("/")
+  tmp_dir = index_dir + ".tmp"
+  old_dir = index_dir + ".old"
+  # start from an empty directory, left overs from a build that didn't finish are removed
+  shutil.rmtree(tmp_dir, ignore_errors=True)
+  os.makedirs(tmp_dir)
+
+  index = {"dir": tmp_dir,
+           "embedding_model": create_embedding_model(model),
+           "dim": None,
+           "embeddings": None,
+           "meta": pd.DataFrame(columns=["path", "breed"]),
+           "ann": None}
+  index = add_to_embedding_index(index, image_paths, breeds)
+
+  # swap the new index in, the old one is only deleted once the new one is in place
+  shutil.rmtree(old_dir, ignore_errors=True)
+  if os.path.exists(index_dir):
+    os.rename(index_dir, old_dir)
+  os.rename(tmp_dir, index_dir)
+  shutil.rmtree(old_dir, ignore_errors=True)
+
+  index["dir"] = index_dir
+  index["embeddings"] = open_embeddings(index)
+  return index
+
+# function for loading a saved embedding index
+def load_embedding_index(model, index_dir=INDEX_DIR):
+  """
+  Loads a saved embedding index, the model has to be the one the index was built with.
+  """
+  print(f"Loading embedding index from: {index_dir}")
+  with open(os.path.join(index_dir, "index.json")) as f:
+    info = json.load(f)
+
+  # only use the rows index.json counts, anything after them is from an add that didn't finish
+  meta = pd.read_csv(os.path.join(index_dir, "meta.csv"))
+  if len(meta) < info["count"]:
+    raise ValueError(f"Embedding index is broken: {len(meta)} images in meta.csv, index.json says {info['count']}")
+
+  index = {"dir": index_dir,
+           "embedding_model": create_embedding_model(model),
+           "dim": info["dim"],
+           "embeddings": None,
+           "meta": meta.iloc[:info["count"]].reset_index(drop=True),
+           "ann": None}
+  index["embeddings"] = open_embeddings(index)
+
+  if faiss is not None:
+    ann_path = os.path.join(index_dir, "hnsw.faiss")
+    if os.path.exists(ann_path):
+      index["ann"] = faiss.read_index(ann_path)
+    # rebuild the graph if it's missing or has different rows (added without faiss, or an add that crashed)
+    if index["ann"] is None or index["ann"].ntotal != info["count"]:
+      rebuild_ann(index)
+  return index
+
+# function for searching the index
+def search_similar_dogs(index, image_path, k=5):
+  """
+  Returns the k training images that look the most like an image, with their breeds and similarity.
+  """
+  start = time.perf_counter()
+  k = min(k, len(index["meta"]))
+  if k == 0:
+    print("The embedding index is empty")
+    return pd.DataFrame(columns=["path", "breed", "similarity"])
+
+  # call the embedding model directly, predict() has too much overhead for one image
+  image = tf.expand_dims(process_image(image_path), axis=0)
+  query = normalize_embeddings(index["embedding_model"](image, training=False).numpy())
+
+  if index["ann"] is not None:
+    index["ann"].hnsw.efSearch = max(64, k)
+    similarities, ids = index["ann"].search(query, k)
+    # faiss pads missing results with -1
+    found = ids[0] >= 0
+    similarities, ids = similarities[0][found], ids[0][found]
+  else:
+    # brute force: one matrix-vector product over the memory-mapped embeddings
+    scores = index["embeddings"] @ query[0]
+    ids = np.argpartition(-scores, k - 1)[:k]
+    ids = ids[np.argsort(-scores[ids])]
+    similarities = scores[ids]
+
+  similar_dogs = index["meta"].iloc[ids].reset_index(drop=True)
+  similar_dogs["similarity"] = similarities
+  print(f"Found {len(similar_dogs)} similar dogs in {(time.perf_counter() - start) * 1000:.1f} ms")
+  return similar_dogs
+
+# function for viewing similar dogs
+def plot_similar_dogs(image_path, similar_dogs):
+  """
+  Plots an image next to the training images that look the most like it.
+  """
+  num_cols = len(similar_dogs) + 1
+  plt.figure(figsize=(3*num_cols, 3))
+  plt.subplot(1, num_cols, 1)
+  plt.imshow(process_image(image_path))
+  plt.title("My dog")
+  plt.axis("off")
+  for i, row in similar_dogs.iterrows():
+    plt.subplot(1, num_cols, i+2)
+    plt.imshow(process_image(row["path"]))
+    plt.title("{} {:.2f}".format(row["breed"], row["similarity"]))
+    plt.axis("off")
+
+# build the index out of the full training set using the full model (only needs to run once, it embeds every training image)
+#embedding_index = build_embedding_index(loaded_full_model, X, labels)
+
+# load the index that was built before
+embedding_index = None
+if os.path.exists(os.path.join(INDEX_DIR, "index.json")):
+  embedding_index = load_embedding_index(loaded_full_model)
+else:
+  print("No embedding index yet, build it with the cell above")
+
+# check the training dogs that look like my first dog
+if embedding_index is not None:
+  similar_dogs = search_similar_dogs(embedding_index, custom_image_paths[0], k=5)
+  plot_similar_dogs(custom_image_paths[0], similar_dogs)
+
+# add my dogs to the index with their predicted breeds (only once, adding them again would add them twice)
+#embedding_index = add_to_embedding_index(embedding_index, custom_image_paths, custom_pred_labels)
+
+"""## Caching predictions
+
+The same photos get predicted over and over (my dogs, the test set, re-uploads), and every time they get decoded and run through the model again.
+
+The prediction cache sits between the prediction helpers and the model:
+* Each image is keyed by a hash of its file contents plus a fingerprint of the model that predicted it
+* Recently used predictions are kept in memory (LRU), all of them are kept in a SQLite file on Drive
+* Both tiers are limited by size, the least recently used predictions are evicted first
+* Cached images skip decoding and predicting entirely
+* Hits and misses are counted so the cache can be checked
+
+The cache lives in `predict_dogs.py` so the batch prediction script can use it too.
+"""
+
+from predict_dogs import create_prediction_cache, predict_with_cache, report_cache_metrics
+
+# open the prediction cache
+prediction_cache = create_prediction_cache()
+
+# predict my dogs through the cache, the second time nothing gets decoded or predicted
+custom_preds = predict_with_cache(loaded_full_model, custom_image_paths, prediction_cache)
+custom_preds = predict_with_cache(loaded_full_model, custom_image_paths, prediction_cache)
+custom_pred_labels = [get_pred_label(custom_preds[i]) for i in range(len(custom_preds))]
+custom_pred_labels
+
+# check the cache
+report_cache_metrics(prediction_cache)
+
+"""## Predicting a whole directory of photos from the command line
+
+`predict_dogs.py` is a command line script that predicts breeds for a directory tree or a list of files of any size:
+* Image files are found and read asynchronously, so reading the next images overlaps with the model predicting the current batch
+* Each image is looked up in the prediction cache, cached images skip decoding and predicting
+* The top k breeds of each image are written to a JSONL or CSV file (picked by the output extension)
+* Throughput and tail latency are reported at the end
+
+Run `python predict_dogs.py --help` for the options.
+"""
+
+# Run the script on my dogs from a terminal (or a Colab cell)
+#!python "drive/MyDrive/Dog Breed Identifier/predict_dogs.py" --model "drive/MyDrive/Dog Breed Identifier/Models/20220117-16091642435743-full-image-set-mobilenetv2-Adam.h5" --output "drive/MyDrive/Dog Breed Identifier/my_dogs_preds.jsonl" "drive/MyDrive/Dog Breed Identifier/MyDogs/"
+
+# or call its main() from here with the same arguments
+import predict_dogs
+predict_dogs.main([custom_path,
+      "--model", "drive/MyDrive/Dog Breed Identifier/Models/20220117-16091642435743-full-image-set-mobilenetv2-Adam.h5",
+      "--output", "drive/MyDrive/Dog Breed Identifier/my_dogs_preds.jsonl"])
+
+"""## Distilling a smaller model for CPU inference
+
+The full model (MobileNetV2 130 at 224px plus the Dense layer) is still heavy for the CPU only inference boxes.
+
+Distillation trains a smaller student model to copy the full (teacher) model:
+* Predict the training images with the teacher through the prediction cache, so the teacher probabilities are only worked out once
+* Mix the teacher probabilities with a bit of the true labels, these are the targets the student trains on (no temperature, so the student's probabilities stay calibrated like the teacher's)
+* Build students out of smaller MobileNetV2's (lower width multiplier and/or 160/128px images) using `create_model()`
+* Check the accuracy of every student on the validation images and time it on the CPU
+* Save every student and compare them on an accuracy/latency plot to pick a cheaper model
+
+**NOTE:** The full model was trained on every image, including the validation images, so its validation accuracy is really training accuracy. It's marked as seen in the results and plotted differently so it isn't compared like for like with the students.
+
+The TF Hub layer stays frozen like in the full model, so only the Dense layer of each student is trained.
+"""
+
+# student models to try (width multiplier, image size)
+STUDENT_CONFIGS = [("100", 160), ("075", 160), ("075", 128), ("050", 128)]
+
+# function for getting the URL of a MobileNetV2 on TensorFlow Hub
+def mobilenet_v2_url(width, img_size):
+  """
+  Returns the TensorFlow Hub URL of the MobileNetV2 classifier with a width multiplier and image size.
+  """
+  return f"https://tfhub.dev/google/imagenet/mobilenet_v2_{width}_{img_size}/classification/5"
+
+# function for timing a saved model on the CPU
+def measure_cpu_latency(model_path, img_size, runs=50):
+  """
+  Loads a saved model onto the CPU and returns the median time in ms it takes to predict one image.
+  """
+  times = []
+  # a model that's already built keeps its weights on the GPU, so load a copy inside the CPU scope
+  with tf.device("/CPU:0"):
+    model = load_model(model_path)
+    image = tf.random.uniform([1, img_size, img_size, 3])
+    # warm up before timing
+    model(image, training=False)
+    for _ in range(runs):
+      start = time.perf_counter()
+      model(image, training=False)
+      times.append(time.perf_counter() - start)
+  return np.median(times) * 1000
+
+# function for training a student
+def train_student(X, targets, width, img_size):
+  """
+  Trains a student model with a MobileNetV2 of the given width and image size on distillation targets.
+  """
+  train_student_data = create_data_batches(X, targets, img_size=img_size)
+  val_student_data = create_data_batches(X_val, y_val, valid_data=True, img_size=img_size)
+
+  student = create_model(input_shape=[None, img_size, img_size, 3],
+                         model_url=mobilenet_v2_url(width, img_size))
+  student.fit(x=train_student_data,
+              epochs=NUM_EPOCHS,
+              validation_data=val_student_data,
+              callbacks=[create_tensorboard_callback(),
+                         tf.keras.callbacks.EarlyStopping(monitor="val_accuracy",
+                                                          patience=3,
+                                                          restore_best_weights=True)])
+  return student, val_student_data
+
+# function for distilling the teacher into students
+def distill_students(teacher, teacher_path, cache, configs=STUDENT_CONFIGS, hard_label_weight=0.3):
+  """
+  Distills a teacher model (saved at teacher_path) into a student for every config and returns their accuracy and CPU latency.
+  """
+  # train on every image except the validation images
+  val_paths = set(X_val)
+  X_distill = [path for path, label in zip(X, y) if path not in val_paths]
+  y_distill = np.array([label for path, label in zip(X, y) if path not in val_paths], dtype="float32")
+
+  # the teacher probabilities are cached so later runs don't predict them again
+  teacher_probs = predict_with_cache(teacher, X_distill, cache, img_size=IMG_SIZE)
+  targets = (hard_label_weight * y_distill
+             + (1 - hard_label_weight) * teacher_probs).astype("float32")
+
+  # the full model was trained on the validation images too, so its accuracy here isn't held out
+  results = [{"model": "teacher mobilenet_v2_130_224 (trained on val images)",
+              "img_size": IMG_SIZE,
+              "val_accuracy": teacher.evaluate(val_data)[1],
+              "val_images_seen": True,
+              "cpu_latency_ms": measure_cpu_latency(teacher_path, IMG_SIZE),
+              "model_path": teacher_path}]
+
+  for width, img_size in configs:
+    student, val_student_data = train_student(X_distill, targets, width, img_size)
+    student_path = save_model(student, suffix=f"student-mobilenetv2-{width}-{img_size}-Adam")
+    results.append({"model": f"student mobilenet_v2_{width}_{img_size}",
+                    "img_size": img_size,
+                    "val_accuracy": student.evaluate(val_student_data)[1],
+                    "val_images_seen": False,
+                    "cpu_latency_ms": measure_cpu_latency(student_path, img_size),
+                    "model_path": student_path})
+
+  return pd.DataFrame(results)
+
+# function for viewing the accuracy/latency trade-off
+def plot_distillation_results(results):
+  """
+  Plots the validation accuracy against the CPU latency of the teacher and the students, marking models that saw the validation images.
+  """
+  plt.figure(figsize=(10, 6))
+  held_out = ~results["val_images_seen"]
+  plt.scatter(results["cpu_latency_ms"][held_out], results["val_accuracy"][held_out],
+              label="held out validation accuracy")
+  plt.scatter(results["cpu_latency_ms"][~held_out], results["val_accuracy"][~held_out],
+              marker="x", color="red", label="trained on the validation images")
+  plt.legend()
+  for _, row in results.iterrows():
+    plt.annotate(row["model"], (row["cpu_latency_ms"], row["val_accuracy"]))
+  plt.xlabel("CPU latency per image (ms)")
+  plt.ylabel("Validation accuracy")
+
+"""**NOTE:** The next cell trains 4 students on the full data set, that takes hours 😅 so it's commented out."""
+
+# distill the full model into the students
+#distillation_results = distill_students(loaded_full_model,
+#                                        "drive/MyDrive/Dog Breed Identifier/Models/20220117-16091642435743-full-image-set-mobilenetv2-Adam.h5",
+#                                        prediction_cache)
+#distillation_results
+
+# check the trade-off between accuracy and latency
+#plot_distillation_results(distillation_results)
+
+"""## Training on new labeled images without retraining from scratch
+
+Adding new photos to `labels.csv` used to mean training the full model from scratch again (30ish minutes).
+
+Incremental training instead:
+* Loads the latest published model version with `load_model()`, along with its breeds and the manifest of the images it was trained on
+* Compares `labels.csv` to that manifest (by breed and image content hash) to find the new or changed images
+* Adds any new breeds to the end of the Dense layer, the weights of the existing breeds are kept
+* Trains on the new images plus a small replay sample of the old ones so the model doesn't forget them
+* Publishes the model, breeds and manifest as a new version, `LATEST.json` is only switched over once everything is written
+
+**NOTE:** New breeds are added to the end, so use the breeds returned with the model to turn its predictions into labels (`get_pred_label(pred, breeds)`). `main()` loads them from the version JSON next to `--model`.
+"""
+
+# where model versions are published
+MODELS_DIR = "drive/MyDrive/Dog Breed Identifier/Models"
+LATEST_MODEL_PATH = os.path.join(MODELS_DIR, "LATEST.json")
+
+import hashlib
+
+# function for hashing a file
+def hash_file(path):
+  """
+  Returns the SHA-256 hash of the contents of a file.
+  """
+  file_hash = hashlib.sha256()
+  with open(path, "rb") as f:
+    for chunk in iter(lambda: f.read(2**20), b""):
+      file_hash.update(chunk)
+  return file_hash.hexdigest()
+
+# function for making a manifest of the training images
+def build_manifest(labels_csv, previous_manifest=None, train_path="drive/MyDrive/Dog Breed Identifier/train/"):
+  """
+  Makes a manifest with the path, breed and content hash of every image in labels.csv.
+  Images with the same size and modification time as in the previous manifest aren't hashed again.
+  """
+  manifest = labels_csv[["id", "breed"]].copy()
+  manifest["path"] = [train_path + fname + ".jpg" for fname in manifest["id"]]
+  stats = [os.stat(path) for path in manifest["path"]]
+  manifest["size"] = [stat.st_size for stat in stats]
+  manifest["mtime"] = [stat.st_mtime for stat in stats]
+
+  known = {}
+  if previous_manifest is not None:
+    known = {(row.path, row.size, row.mtime): row.sha256 for row in previous_manifest.itertuples()}
+  manifest["sha256"] = [known.get((row.path, row.size, row.mtime)) or hash_file(row.path)
+                        for row in manifest.itertuples()]
+  return manifest
+
+# function for finding new or changed images
+def find_new_rows(manifest, previous_manifest):
+  """
+  Returns the rows of a manifest that aren't in the previous manifest or have a different breed or image.
+  """
+  merged = manifest.merge(previous_manifest[["id", "breed", "sha256"]],
+                          on="id", how="left", suffixes=("", "_previous"))
+  changed = (merged["breed"] != merged["breed_previous"]) | (merged["sha256"] != merged["sha256_previous"])
+  return manifest[changed.to_numpy()]
+
+# function for publishing a model version
+def publish_model_version(model, breeds, manifest, suffix):
+  """
+  Saves a model with its breeds and training manifest as a new version and points LATEST.json at it.
+  """
+  version = datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + "-" + suffix
+  model_path = os.path.join(MODELS_DIR, version + ".h5")
+  manifest_path = os.path.join(MODELS_DIR, version + "-manifest.csv")
+  print(f"Publishing model version: {version}...")
+
+  # write everything under temporary names first so a half written version is never loaded
+  model.save(model_path + ".tmp", save_format="h5")
+  manifest.to_csv(manifest_path + ".tmp", index=False)
+  os.replace(model_path + ".tmp", model_path)
+  os.replace(manifest_path + ".tmp", manifest_path)
+
+  version_info = {"version": version,
+                  "model_path": model_path,
+                  "manifest_path": manifest_path,
+                  "breeds": [str(breed) for breed in breeds]}
+  write_json_atomically(version_info, os.path.join(MODELS_DIR, version + ".json"))
+  # switching LATEST.json over is what publishes the version
+  write_json_atomically(version_info, LATEST_MODEL_PATH)
+  return model_path
+
+# function for loading the latest model version
+def load_latest_model():
+  """
+  Loads the latest published model with its breeds and training manifest.
+  """
+  if not os.path.exists(LATEST_MODEL_PATH):
+    raise FileNotFoundError(f"No published model at {LATEST_MODEL_PATH}, publish the first version with publish_model_version()")
+  with open(LATEST_MODEL_PATH) as f:
+    version_info = json.load(f)
+  model = load_model(version_info["model_path"])
+  manifest = pd.read_csv(version_info["manifest_path"])
+  return model, np.array(version_info["breeds"]), manifest
+
+# function for adding new breeds to a model
+def grow_output_layer(model, num_breeds):
+  """
+  Replaces the Dense output layer of a model with a bigger one, keeping the weights of the existing breeds.
+  """
+  old_kernel, old_bias = model.layers[-1].get_weights()
+  num_old_breeds = old_kernel.shape[1]
+  print(f"Growing the output layer from {num_old_breeds} to {num_breeds} breeds")
+
+  # reuse the TF Hub layer, only the output layer is new
+  grown_model = tf.keras.Sequential(model.layers[:-1] + [
+    tf.keras.layers.Dense(units=num_breeds,
+                          activation="softmax")
+  ])
+  grown_model.build(INPUT_SHAPE)
+
+  # copy the existing breeds into the first columns, the new breeds keep their fresh weights
+  kernel, bias = grown_model.layers[-1].get_weights()
+  kernel[:, :num_old_breeds] = old_kernel
+  bias[:num_old_breeds] = old_bias
+  grown_model.layers[-1].set_weights([kernel, bias])
+  return grown_model
+
+# function for training on new images only
+def incremental_train(labels_csv, replay_size=500, learning_rate=1e-4):
+  """
+  Trains the latest model on the new or changed images in labels.csv plus a replay sample of old images,
+  then publishes it as a new version. Returns the model and its breeds.
+  """
+  model, breeds, previous_manifest = load_latest_model()
+  manifest = build_manifest(labels_csv, previous_manifest)
+  new_rows = find_new_rows(manifest, previous_manifest)
+  if len(new_rows) == 0:
+    print("No new or changed images, nothing to train on")
+    return model, breeds
+  print(f"Found {len(new_rows)} new or changed images")
+
+  # new breeds go on the end so the existing breeds keep their index
+  new_breeds = sorted(set(new_rows["breed"]) - set(breeds))
+  if new_breeds:
+    print("New breeds:", new_breeds)
+    breeds = np.array(list(breeds) + new_breeds)
+    model = grow_output_layer(model, len(breeds))
+
+  # mix in a sample of old images so the model doesn't forget them
+  old_rows = manifest[~manifest["id"].isin(new_rows["id"])]
+  replay_rows = old_rows.sample(n=min(replay_size, len(old_rows)), random_state=42)
+  rows = pd.concat([new_rows, replay_rows])
+
+  X_incremental = list(rows["path"])
+  y_incremental = [breed == breeds for breed in rows["breed"]]
+  incremental_data = create_data_batches(X_incremental, y_incremental)
+
+  # a small learning rate so the existing weights don't move too far
+  model.compile(
+      loss=tf.keras.losses.CategoricalCrossentropy(),
+      optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate),
+      metrics=["accuracy"]
+  )
+  model.fit(x=incremental_data,
+            epochs=NUM_EPOCHS,
+            callbacks=[create_tensorboard_callback(),
+                       tf.keras.callbacks.EarlyStopping(monitor="accuracy",
+                                                        patience=3)])
+
+  publish_model_version(model, breeds, manifest, suffix=f"incremental-{len(new_rows)}-images-mobilenetv2-Adam")
+  return model, breeds
+
+# publish the full model as the first version (only needs to run once, it hashes every training image)
+#publish_model_version(loaded_full_model, unique_breeds, build_manifest(labels_csv), suffix="full-image-set-mobilenetv2-Adam")
+
+# re-read labels.csv with the new rows added and train on them (needs the first version published above)
+#labels_csv = pd.read_csv("/content/drive/MyDrive/Dog Breed Identifier/labels.csv")
+#incremental_model, incremental_breeds = incremental_train(labels_csv)
+
+# label my dogs with the breeds of the incremental model, it may have breeds unique_breeds doesn't
+#incremental_preds = predict_with_cache(incremental_model, custom_image_paths, prediction_cache)
+#[get_pred_label(pred, incremental_breeds) for pred in incremental_preds]
+
+"""## Auto-tuning batch size, threads and image size for this machine
+
+`BATCH_SIZE = 32` and `IMG_SIZE = 224` aren't the best values on every machine, the training machines and the inference boxes are different.
+
+The auto-tuner runs short calibration sweeps on this machine:
+* Number of threads preparing images (`num_parallel_calls` in `create_data_batches()`)
+* Batch size for predicting and for training
+* Image size for predicting
+* For each one it measures throughput, latency per batch, how much the memory (RSS) grows and peak GPU memory, setups that run out of memory are marked instead of stopping the sweep
+
+The best values are saved as this machine's profile, which is loaded at the top of the notebook the next time it runs.
+The image size is only used for predicting (`PREDICT_IMG_SIZE`), training and saved models stay at `IMG_SIZE`. It only changes from 224 if a latency budget is given, and only to sizes where the trained model loses at most `max_accuracy_drop` validation accuracy, because smaller images are less accurate.
+
+**NOTE:** The number of threads TensorFlow uses inside ops can't be changed after it starts, so only the input pipeline threads are tuned.
+"""
+
+import threading
+
+# function for checking how much memory this process is using
+def current_rss_mb():
+  """
+  Returns the resident memory (RSS) of this process in MB.
+  """
+  try:
+    with open("/proc/self/status") as f:
+      for line in f:
+        if line.startswith("VmRSS:"):
+          return int(line.split()[1]) / 1024
+  except OSError:
+    pass
+  # not on Linux, fall back to the peak so far
+  import resource
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# function for measuring peak memory
+def measure_peak_rss(fn):
+  """
+  Runs fn while sampling the RSS of this process, returns the result of fn and how far the RSS went above
+  where it started in MB (the process keeps memory from earlier setups, so only the increase is counted).
+  """
+  baseline = current_rss_mb()
+  peak = [baseline]
+  done = threading.Event()
+
+  def sample():
+    while not done.is_set():
+      peak[0] = max(peak[0], current_rss_mb())
+      time.sleep(0.01)
+
+  sampler = threading.Thread(target=sample, daemon=True)
+  sampler.start()
+  try:
+    result = fn()
+  finally:
+    done.set()
+    sampler.join()
+  return result, peak[0] - baseline
+
+# function for timing a model on batches of data
+def time_batches(data, run_batch):
+  """
+  Runs every batch of a dataset through run_batch and returns the images per second and batch times in ms.
+  """
+  num_images = 0
+  batch_times = []
+  start = last = time.perf_counter()
+  for batch in data:
+    images = batch[0] if isinstance(batch, tuple) else batch
+    run_batch(batch)
+    now = time.perf_counter()
+    # includes waiting for the input pipeline, that's what the threads change
+    batch_times.append((now - last) * 1000)
+    num_images += int(images.shape[0])
+    last = now
+  return num_images / (last - start), batch_times
+
+# function for measuring one setup
+def measure_setup(mode, run, batch_size, img_size, num_parallel_calls):
+  """
+  Runs one calibration setup and returns its throughput, batch latency, RSS increase and peak GPU memory.
+  Running out of memory marks the setup as out_of_memory instead of stopping the sweep.
+  """
+  measurement = {"mode": mode,
+                 "batch_size": batch_size,
+                 "img_size": img_size,
+                 "num_parallel_calls": num_parallel_calls,
+                 "images_per_second": 0.0,
+                 "p50_batch_ms": np.nan,
+                 "p95_batch_ms": np.nan,
+                 "rss_increase_mb": np.nan,
+                 "peak_gpu_mb": np.nan,
+                 "out_of_memory": False}
+
+  # on the GPU machines the batch size is limited by GPU memory, so track its peak for each setup
+  gpu = tf.config.list_physical_devices("GPU")
+  if gpu:
+    tf.config.experimental.reset_memory_stats("GPU:0")
+  try:
+    (throughput, batch_times), rss_increase = measure_peak_rss(run)
+    measurement.update({"images_per_second": throughput,
+                        "p50_batch_ms": np.percentile(batch_times, 50),
+                        "p95_batch_ms": np.percentile(batch_times, 95),
+                        "rss_increase_mb": rss_increase})
+  except tf.errors.ResourceExhaustedError:
+    print(f"Out of memory: {mode} with batch size {batch_size} at {img_size}px")
+    measurement["out_of_memory"] = True
+  if gpu:
+    measurement["peak_gpu_mb"] = tf.config.experimental.get_memory_info("GPU:0")["peak"] / 2**20
+  return measurement
+
+# function for measuring one prediction setup
+def measure_prediction(model, image_paths, batch_size, img_size, num_parallel_calls):
+  """
+  Measures predicting image_paths with a batch size, image size and number of input threads.
+  """
+  data = create_data_batches(image_paths, test_data=True, batch_size=batch_size,
+                             img_size=img_size, num_parallel_calls=num_parallel_calls)
+
+  def run():
+    # warm up so tracing isn't timed
+    model.predict_on_batch(tf.zeros([batch_size, img_size, img_size, 3]))
+    return time_batches(data, model.predict_on_batch)
+
+  return measure_setup("predict", run, batch_size, img_size, num_parallel_calls)
+
+# function for measuring one training setup
+def measure_training(model, image_paths, image_labels, batch_size, img_size, num_parallel_calls):
+  """
+  Measures training on image_paths with a batch size, image size and number of input threads.
+  """
+  data = create_data_batches(image_paths, image_labels, batch_size=batch_size,
+                             img_size=img_size, num_parallel_calls=num_parallel_calls)
+
+  def run():
+    # warm up so tracing isn't timed
+    model.train_on_batch(tf.zeros([batch_size, img_size, img_size, 3]),
+                         tf.one_hot(tf.zeros([batch_size], dtype=tf.int32), OUTPUT_SHAPE))
+    return time_batches(data, lambda batch: model.train_on_batch(*batch))
+
+  return measure_setup("train", run, batch_size, img_size, num_parallel_calls)
+
+# function for checking accuracy at a smaller image size
+def evaluate_at_img_size(model, img_size):
+  """
+  Returns the accuracy of a trained model on the validation images resized to img_size.
+  """
+  # share the trained layers in a model built for the new image size
+  resized_model = tf.keras.Sequential(model.layers)
+  resized_model.build([None, img_size, img_size, 3])
+  resized_model.compile(loss=tf.keras.losses.CategoricalCrossentropy(), metrics=["accuracy"])
+  return resized_model.evaluate(create_data_batches(X_val, y_val, valid_data=True, img_size=img_size))[1]
+
+# function for running the calibration sweeps
+def tune_host(image_paths=X[:512],
+              image_labels=y[:512],
+              batch_sizes=(8, 16, 32, 64, 128),
+              thread_counts=(1, 2, 4, os.cpu_count(), tf.data.AUTOTUNE),
+              img_sizes=(224, 192, 160, 128),
+              max_latency_ms=None,
+              model=None,
+              max_accuracy_drop=0.01,
+              memory_limit_mb=None,
+              profiles_dir=PROFILES_DIR):
+  """
+  Runs calibration sweeps on this machine, saves the best setup as its profile and returns all the measurements.
+  memory_limit_mb is how much the RSS may grow during a setup.
+  With a latency budget, smaller image sizes are only used if the trained model loses at most max_accuracy_drop
+  validation accuracy at them.
+  """
+  if max_latency_ms is not None and model is None:
+    raise ValueError("pass the trained model to check its accuracy at smaller image sizes")
+  if memory_limit_mb is None:
+    # leave 20% of the machine's memory free
+    total_mb = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 2**20
+    memory_limit_mb = 0.8 * total_mb - current_rss_mb()
+  thread_counts = list(dict.fromkeys(thread_counts))
+  measurements = []
+
+  # 1. input threads, at the current batch size and the training image size
+  model = create_model()
+  for num_parallel_calls in thread_counts:
+    measurements.append(measure_prediction(model, image_paths, PREDICT_BATCH_SIZE, IMG_SIZE, num_parallel_calls))
+  threads = [m for m in measurements if not m["out_of_memory"]]
+  best_threads = max(threads, key=lambda m: m["images_per_second"])["num_parallel_calls"] if threads else NUM_PARALLEL_CALLS
+
+  # 2. prediction batch size and image size, with the best number of threads
+  for img_size in img_sizes:
+    model = create_model(input_shape=[None, img_size, img_size, 3])
+    for batch_size in batch_sizes:
+      measurements.append(measure_prediction(model, image_paths, batch_size, img_size, best_threads))
+
+  # 3. training batch size, always at the image size the models are trained at
+  model = create_model()
+  for batch_size in batch_sizes:
+    measurements.append(measure_training(model, image_paths, image_labels, batch_size, IMG_SIZE, best_threads))
+
+  results = pd.DataFrame(measurements)
+
+  # smaller images are faster but less accurate, so check the trained model at each image size
+  results["val_accuracy"] = np.nan
+  accurate_enough = pd.Series(True, index=results.index)
+  if max_latency_ms is not None:
+    accuracies = {img_size: evaluate_at_img_size(model, img_size) for img_size in set(img_sizes) | {IMG_SIZE}}
+    reference_accuracy = accuracies[IMG_SIZE]
+    print("Validation accuracy at each image size:", accuracies)
+    is_predict = results["mode"] == "predict"
+    results.loc[is_predict, "val_accuracy"] = results.loc[is_predict, "img_size"].map(accuracies)
+    accurate_enough = ~is_predict | (results["val_accuracy"] >= reference_accuracy - max_accuracy_drop)
+
+  fits = ~results["out_of_memory"] & (results["rss_increase_mb"] <= memory_limit_mb) & accurate_enough
+
+  # biggest image size (most accurate) that has a batch size within the latency budget, then the fastest batch size
+  predict_results = results[(results["mode"] == "predict") & fits & (results["num_parallel_calls"] == best_threads)]
+  if max_latency_ms is not None:
+    predict_results = predict_results[predict_results["p95_batch_ms"] <= max_latency_ms]
+  else:
+    predict_results = predict_results[predict_results["img_size"] == IMG_SIZE]
+  if len(predict_results) == 0:
+    print("Nothing fits the memory limit, latency budget and accuracy drop, keeping the current prediction setup")
+    predict_batch_size, predict_img_size = PREDICT_BATCH_SIZE, PREDICT_IMG_SIZE
+  else:
+    predict_results = predict_results[predict_results["img_size"] == predict_results["img_size"].max()]
+    best_predict = predict_results.loc[predict_results["images_per_second"].idxmax()]
+    predict_batch_size, predict_img_size = int(best_predict["batch_size"]), int(best_predict["img_size"])
+
+  train_results = results[(results["mode"] == "train") & fits]
+  if len(train_results) == 0:
+    print("No training batch size fits the memory limit, keeping the current one")
+    train_batch_size = BATCH_SIZE
+  else:
+    train_batch_size = int(train_results.loc[train_results["images_per_second"].idxmax()]["batch_size"])
+
+  # the image size is only used for predicting, training and saved models stay at IMG_SIZE
+  profile = {"host": socket.gethostname(),
+             "tuned_at": datetime.datetime.now().isoformat(),
+             "predict_img_size": predict_img_size,
+             "predict_batch_size": predict_batch_size,
+             "train_batch_size": train_batch_size,
+             "num_parallel_calls": best_threads,
+             "measurements": results.to_dict(orient="records")}
+
+  os.makedirs(profiles_dir, exist_ok=True)
+  profile_path = os.path.join(profiles_dir, socket.gethostname() + ".json")
+  write_json_atomically(profile, profile_path)
+  print(f"Saved tuning profile to: {profile_path} (restart the runtime to use it)")
+  print({key: value for key, value in profile.items() if key != "measurements"})
+  return results
+
+# tune this machine (takes a while and overwrites its profile, so only run it when the machine changes)
+#tuning_results = tune_host()
+
+# or with a latency budget, checking the full model's accuracy at smaller image sizes
+#tuning_results = tune_host(max_latency_ms=200, model=loaded_full_model)
+#tuning_results
@@ -0,0 +1,530 @@
+# -*- coding: utf-8 -*-
+"""Dog Breed Identifier - batch predictions
+
+Predicts dog breeds for a directory tree or a list of photos of any size with a model saved by the notebook
+(dog_breed_identifier.py), and holds the pieces the notebook shares with it: the host tuning profile,
+image decoding and the prediction cache.
+
+Usage:
+  python predict_dogs.py --model "Models/<model>.h5" --output preds.jsonl photos/ more_photos/
+  python predict_dogs.py --model "Models/<model>.h5" --file-list photos.txt --output preds.csv
+
+How it works:
+* Image files are found and read asynchronously, so reading the next images overlaps with the model predicting the current batch
+* Each image is looked up in the prediction cache, cached images skip decoding and predicting
+* The top k breeds of each image are written to a JSONL or CSV file (picked by the output extension)
+* Throughput and tail latency are reported at the end
+"""
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import csv
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+import tensorflow_hub as hub
+
+# where the per-host tuning profiles, labels and prediction cache are stored
+PROFILES_DIR = "drive/MyDrive/Dog Breed Identifier/profiles"
+LABELS_PATH = "drive/MyDrive/Dog Breed Identifier/labels.csv"
+PREDICTION_CACHE_PATH = "drive/MyDrive/Dog Breed Identifier/prediction_cache.sqlite"
+
+# file types decode_image can decode
+IMAGE_EXTENSIONS = (".jpg", ".jpeg")
+
+# function for loading the tuning profile of this machine
+def load_host_profile(profiles_dir=PROFILES_DIR):
+  """
+  Loads the tuning profile of this machine, or an empty profile if it hasn't been tuned.
+  """
+  profile_path = os.path.join(profiles_dir, socket.gethostname() + ".json")
+  if not os.path.exists(profile_path):
+    print(f"No tuning profile for {socket.gethostname()}, using the defaults")
+    return {}
+  print(f"Loading tuning profile from: {profile_path}")
+  with open(profile_path) as f:
+    return json.load(f)
+
+HOST_PROFILE = load_host_profile()
+
+# image size the models are trained at, and the image size and batch size for predicting on this machine
+IMG_SIZE = 224
+PREDICT_IMG_SIZE = HOST_PROFILE.get("predict_img_size", IMG_SIZE)
+PREDICT_BATCH_SIZE = HOST_PROFILE.get("predict_batch_size", HOST_PROFILE.get("train_batch_size", 32))
+
+# function for preprocessing images that are already read in
+def decode_image(image, img_size=IMG_SIZE):
+  """
+  Takes the raw bytes of an image file and turns them into a tensor.
+  """
+  # turn the image inot tensor with 3 color channels
+  image = tf.image.decode_jpeg(image, channels=3)
+
+  # convert the color channel values from 0-255 to 0-1 values 
+  image = tf.image.convert_image_dtype(image, tf.float32)
+
+  # Resize the image to (224, 224)
+  image = tf.image.resize(image, size=[img_size, img_size])
+
+  return image
+
+# Function to load model
+def load_model(model_path):
+  """
+  Loads a saved model from a specified path.
+  """
+  print(f"Loading saved model from: {model_path}")
+  model = tf.keras.models.load_model(model_path,
+                                     custom_objects={"KerasLayer":hub.KerasLayer})
+  return model
+
+# function for creating a prediction cache
+def create_prediction_cache(db_path=PREDICTION_CACHE_PATH, memory_bytes=64*2**20, disk_bytes=2**30):
+  """
+  Opens (or creates) a prediction cache with an in-memory LRU tier and a SQLite tier.
+  """
+  print(f"Opening prediction cache: {db_path}")
+  # the cache is shared with the batch prediction threads, the lock keeps it consistent
+  # wait for other connections to the same file (like the one main() opens) instead of failing straight away
+  db = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+  db.execute("PRAGMA journal_mode=WAL")
+  db.execute("PRAGMA synchronous=NORMAL")
+  db.execute("""CREATE TABLE IF NOT EXISTS predictions (
+                  key TEXT PRIMARY KEY,
+                  probs BLOB NOT NULL,
+                  size INTEGER NOT NULL,
+                  last_used REAL NOT NULL)""")
+  db.execute("CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)")
+  db.commit()
+
+  return {"db": db,
+          "lock": threading.Lock(),
+          "memory": collections.OrderedDict(),
+          "memory_size": 0,
+          "memory_bytes": memory_bytes,
+          "disk_size": db.execute("SELECT COALESCE(SUM(size), 0) FROM predictions").fetchone()[0],
+          "disk_bytes": disk_bytes,
+          "touched": {},
+          "stats": {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}}
+
+# function for closing a prediction cache
+def close_prediction_cache(cache):
+  """
+  Commits and closes the SQLite file of a prediction cache.
+  """
+  with cache["lock"]:
+    write_cache_touches(cache)
+    cache["db"].commit()
+    cache["db"].close()
+
+# function for saving when cached predictions were last used
+def write_cache_touches(cache):
+  """
+  Writes the last used times of the predictions looked up since the last commit (the lock has to be held).
+  """
+  if cache["touched"]:
+    cache["db"].executemany("UPDATE predictions SET last_used = ? WHERE key = ?",
+                            [(last_used, key) for key, last_used in cache["touched"].items()])
+    cache["touched"].clear()
+
+# function for committing a prediction cache
+def commit_prediction_cache(cache):
+  """
+  Writes the last used times of looked up predictions and commits, so the SQLite file isn't left locked.
+  """
+  with cache["lock"]:
+    write_cache_touches(cache)
+    cache["db"].commit()
+
+# function that puts predictions in the memory tier
+def remember_prediction(cache, key, probs):
+  """
+  Puts prediction probabilities at the front of the memory LRU and evicts the oldest ones if it's full.
+  """
+  if key in cache["memory"]:
+    cache["memory_size"] -= cache["memory"].pop(key).nbytes
+  cache["memory"][key] = probs
+  cache["memory_size"] += probs.nbytes
+  while cache["memory_size"] > cache["memory_bytes"]:
+    _, old_probs = cache["memory"].popitem(last=False)
+    cache["memory_size"] -= old_probs.nbytes
+
+# function for looking up a prediction
+def cache_get(cache, key):
+  """
+  Returns the cached prediction probabilities for a key, or None if they aren't cached.
+  """
+  with cache["lock"]:
+    # memory tier
+    if key in cache["memory"]:
+      cache["memory"].move_to_end(key)
+      cache["touched"][key] = time.time()
+      cache["stats"]["memory_hits"] += 1
+      return cache["memory"][key]
+
+    # disk tier
+    row = cache["db"].execute("SELECT probs FROM predictions WHERE key = ?", (key,)).fetchone()
+    if row is None:
+      cache["stats"]["misses"] += 1
+      return None
+    # last used times are written with the next commit, an UPDATE here would hold the write lock until then
+    cache["touched"][key] = time.time()
+    probs = np.frombuffer(row[0], dtype="float32")
+    remember_prediction(cache, key, probs)
+    cache["stats"]["disk_hits"] += 1
+    return probs
+
+# function for adding a prediction
+def cache_put(cache, key, probs):
+  """
+  Stores prediction probabilities in both tiers of the cache.
+  """
+  cache_put_batch(cache, [(key, probs)])
+
+# function for adding a batch of predictions
+def cache_put_batch(cache, items):
+  """
+  Stores a list of (key, prediction probabilities) in both tiers of the cache with one commit.
+  """
+  now = time.time()
+  with cache["lock"]:
+    for key, probs in items:
+      # copy so the cache doesn't keep the whole batch of predictions alive through a row view
+      probs = np.array(probs, dtype="float32", copy=True)
+      remember_prediction(cache, key, probs)
+      old = cache["db"].execute("SELECT size FROM predictions WHERE key = ?", (key,)).fetchone()
+      cache["db"].execute("INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)",
+                          (key, probs.tobytes(), probs.nbytes, now))
+      cache["disk_size"] += probs.nbytes - (old[0] if old else 0)
+    write_cache_touches(cache)
+
+    # other connections to the same file may have added or evicted rows, so check the real size before evicting
+    if cache["disk_size"] > cache["disk_bytes"]:
+      cache["disk_size"] = cache["db"].execute("SELECT COALESCE(SUM(size), 0) FROM predictions").fetchone()[0]
+
+    # evict the least recently used predictions until the file fits again
+    while cache["disk_size"] > cache["disk_bytes"]:
+      oldest = cache["db"].execute("SELECT key, size FROM predictions ORDER BY last_used LIMIT 100").fetchall()
+      if not oldest:
+        break
+      for old_key, size in oldest:
+        cache["db"].execute("DELETE FROM predictions WHERE key = ?", (old_key,))
+        cache["disk_size"] -= size
+        cache["stats"]["evictions"] += 1
+        if cache["disk_size"] <= cache["disk_bytes"]:
+          break
+    cache["db"].commit()
+
+# function for fingerprinting a model
+def model_fingerprint(model, img_size=PREDICT_IMG_SIZE):
+  """
+  Hashes the weights of a model (and the image size it's fed) so cached predictions from other models aren't used.
+  """
+  fingerprint = hashlib.sha256(str(img_size).encode())
+  for weight in model.weights:
+    fingerprint.update(weight.numpy().tobytes())
+  return fingerprint.hexdigest()[:16]
+
+# function for making the cache key of an image
+def image_cache_key(fingerprint, image_bytes):
+  """
+  Makes a cache key out of a model fingerprint and the contents of an image file.
+  """
+  return fingerprint + ":" + hashlib.sha256(image_bytes).hexdigest()
+
+# function for predicting through the cache
+def predict_with_cache(model, image_paths, cache, batch_size=PREDICT_BATCH_SIZE, img_size=PREDICT_IMG_SIZE):
+  """
+  Returns an array of prediction probabilities for a list of image paths, only decoding and predicting images that aren't cached.
+  """
+  fingerprint = model_fingerprint(model, img_size)
+  predictions = [None] * len(image_paths)
+  num_missed = 0
+
+  # go through the images a batch at a time so only one batch of image bytes is held at once
+  for start in range(0, len(image_paths), batch_size):
+    missed = []
+    for i in range(start, min(start + batch_size, len(image_paths))):
+      with open(image_paths[i], "rb") as f:
+        image_bytes = f.read()
+      key = image_cache_key(fingerprint, image_bytes)
+      predictions[i] = cache_get(cache, key)
+      if predictions[i] is None:
+        missed.append((i, key, image_bytes))
+
+    # predict the ones that aren't cached
+    if missed:
+      images = tf.stack([decode_image(image_bytes, img_size) for _, _, image_bytes in missed])
+      batch_predictions = np.asarray(model.predict_on_batch(images))
+      cache_put_batch(cache, [(key, probs) for (_, key, _), probs in zip(missed, batch_predictions)])
+      for (i, _, _), probs in zip(missed, batch_predictions):
+        predictions[i] = probs
+      num_missed += len(missed)
+
+  # save the last used times of the cached images and release the write lock
+  commit_prediction_cache(cache)
+
+  print(f"Predicted {num_missed} of {len(image_paths)} images, {len(image_paths) - num_missed} were cached")
+  return np.array(predictions)
+
+# function for checking the cache
+def report_cache_metrics(cache):
+  """
+  Prints the hits, misses, evictions and size of a prediction cache and returns its hit rate.
+  """
+  stats = cache["stats"]
+  lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+  hit_rate = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+  print(f"Memory hits: {stats['memory_hits']}, disk hits: {stats['disk_hits']}, misses: {stats['misses']}")
+  print(f"Hit rate: {hit_rate:.1%}, evictions: {stats['evictions']}")
+  print(f"Memory tier: {cache['memory_size'] / 2**20:.1f} MB, disk tier: {cache['disk_size'] / 2**20:.1f} MB")
+  return hit_rate
+
+# function for getting the top k breeds of a prediction
+def get_top_k(prediction_probabilities, breeds, k=5):
+  """
+  Turns an array of prediction probabilities into a list of the top k breeds and their probabilities.
+  """
+  top_k_indexes = prediction_probabilities.argsort()[-k:][::-1]
+  return [{"breed": str(breeds[i]), "probability": float(prediction_probabilities[i])}
+          for i in top_k_indexes]
+
+# function for finding the breeds of a saved model
+def load_model_breeds(model_path, breeds_path=None, labels_path=LABELS_PATH):
+  """
+  Loads the breeds of a saved model from a version JSON (or a JSON list of breeds).
+  Without breeds_path the version JSON next to the model is used, if there isn't one the model has the
+  original breeds from labels.csv.
+  """
+  if breeds_path is None:
+    breeds_path = os.path.splitext(model_path)[0] + ".json"
+    if not os.path.exists(breeds_path):
+      print(f"Loading breeds from: {labels_path}")
+      return np.unique(pd.read_csv(labels_path)["breed"])
+  print(f"Loading breeds from: {breeds_path}")
+  with open(breeds_path) as f:
+    breeds = json.load(f)
+  # published model versions keep their breeds next to the rest of the version info
+  if isinstance(breeds, dict):
+    breeds = breeds["breeds"]
+  return np.array(breeds)
+
+# function for writing results to a JSONL or CSV file
+def open_results_writer(output_path, top_k):
+  """
+  Opens an output file and returns it with a function that writes one result row to it.
+  """
+  f = open(output_path, "w", newline="")
+  if output_path.endswith(".csv"):
+    writer = csv.writer(f)
+    header = ["path", "sha256"]
+    for i in range(1, top_k+1):
+      header += [f"breed_{i}", f"probability_{i}"]
+    writer.writerow(header)
+
+    def write_row(row):
+      values = [row["path"], row["sha256"]]
+      for pred in row["top_k"]:
+        values += [pred["breed"], pred["probability"]]
+      writer.writerow(values)
+  else:
+    def write_row(row):
+      f.write(json.dumps(row) + "\n")
+  return f, write_row
+
+# function for reading an image file
+def read_image_file(image_path, cache, fingerprint, img_size):
+  """
+  Reads an image file and looks it up in the prediction cache, the image is only decoded if it isn't cached.
+  """
+  with open(image_path, "rb") as f:
+    image_bytes = f.read()
+  key = image_cache_key(fingerprint, image_bytes)
+  probs = cache_get(cache, key)
+  if probs is not None:
+    return key, probs, None
+  return key, None, decode_image(image_bytes, img_size)
+
+# finds image files and puts their paths in a queue
+async def discover_images(paths, path_queue, num_readers):
+  """
+  Walks through the given files and directories and puts every image path in the path queue.
+  """
+  for path in paths:
+    if os.path.isdir(path):
+      walker = os.walk(path)
+      while True:
+        # list one directory at a time in a thread so the event loop isn't blocked
+        step = await asyncio.to_thread(next, walker, None)
+        if step is None:
+          break
+        root, dirs, files = step
+        dirs.sort()
+        for fname in sorted(files):
+          if fname.lower().endswith(IMAGE_EXTENSIONS):
+            await path_queue.put(os.path.join(root, fname))
+    else:
+      await path_queue.put(path)
+
+  # tell every reader there are no more images
+  for _ in range(num_readers):
+    await path_queue.put(None)
+
+# reads and decodes images from the path queue
+async def read_images(path_queue, image_queue, cache, fingerprint, img_size):
+  """
+  Reads images from the path queue and puts them in the image queue.
+  """
+  while True:
+    path = await path_queue.get()
+    if path is None:
+      await image_queue.put(None)
+      return
+    start = time.perf_counter()
+    try:
+      key, probs, image = await asyncio.to_thread(read_image_file, path, cache, fingerprint, img_size)
+    except (OSError, sqlite3.Error, tf.errors.InvalidArgumentError) as e:
+      print(f"Skipping {path}: {e}")
+      continue
+    await image_queue.put({"path": path, "key": key, "probs": probs, "image": image, "start": start})
+
+# predicts batches of images from the image queue
+async def predict_images(model, image_queue, num_readers, write_row, cache, stats, batch_size, top_k, breeds):
+  """
+  Takes images from the image queue in batches, predicts them and writes the results.
+  """
+  def finish(item, probs, cached):
+    # the key is the model fingerprint and the content hash of the image
+    write_row({"path": item["path"],
+               "sha256": item["key"].split(":")[1],
+               "top_k": get_top_k(probs, breeds, top_k)})
+    stats["latencies"].append(time.perf_counter() - item["start"])
+    stats["cached"] += cached
+
+  finished_readers = 0
+  while finished_readers < num_readers:
+    # wait for one image, then take whatever else is already waiting up to a full batch
+    batch = []
+    item = await image_queue.get()
+    while True:
+      if item is None:
+        finished_readers += 1
+      elif item["image"] is None:
+        finish(item, item["probs"], cached=1)
+      else:
+        batch.append(item)
+      if len(batch) == batch_size or finished_readers == num_readers or image_queue.empty():
+        break
+      item = image_queue.get_nowait()
+
+    if batch:
+      # predict in a thread so the readers keep going
+      images = tf.stack([item["image"] for item in batch])
+      predictions = await asyncio.to_thread(model.predict_on_batch, images)
+      predictions = np.asarray(predictions)
+      cache_put_batch(cache, [(item["key"], probs) for item, probs in zip(batch, predictions)])
+      for item, probs in zip(batch, predictions):
+        finish(item, probs, cached=0)
+
+# function that runs the whole pipeline
+async def predict_files(model, paths, output_path, cache, breeds, top_k=5, batch_size=PREDICT_BATCH_SIZE,
+                        num_readers=8, img_size=PREDICT_IMG_SIZE):
+  """
+  Predicts the top k breeds of every image in paths and writes them to output_path.
+  """
+  fingerprint = model_fingerprint(model, img_size)
+  stats = {"latencies": [], "cached": 0}
+
+  path_queue = asyncio.Queue(maxsize=4*batch_size)
+  image_queue = asyncio.Queue(maxsize=4*batch_size)
+
+  start = time.perf_counter()
+  output_file, write_row = open_results_writer(output_path, top_k)
+  with output_file:
+    await asyncio.gather(
+        discover_images(paths, path_queue, num_readers),
+        *[read_images(path_queue, image_queue, cache, fingerprint, img_size) for _ in range(num_readers)],
+        predict_images(model, image_queue, num_readers, write_row, cache,
+                       stats, batch_size, top_k, breeds))
+  stats["seconds"] = time.perf_counter() - start
+
+  report_throughput(stats)
+  return stats
+
+# function for reporting throughput and latency
+def report_throughput(stats):
+  """
+  Prints the throughput and the latency percentiles of a prediction run.
+  """
+  num_images = len(stats["latencies"])
+  print(f"Predicted {num_images} images ({stats['cached']} cached) in {stats['seconds']:.1f} s")
+  if num_images:
+    p50, p95, p99 = np.percentile(stats["latencies"], [50, 95, 99]) * 1000
+    print(f"Throughput: {num_images / stats['seconds']:.1f} images/s")
+    print(f"Latency: p50 {p50:.0f} ms, p95 {p95:.0f} ms, p99 {p99:.0f} ms")
+
+# command line entry point
+def main(argv=None):
+  """
+  Predicts dog breeds for directories or lists of photos, run with --help for the options.
+  """
+  parser = argparse.ArgumentParser(description="Predict dog breeds for a directory tree or list of photos.")
+  parser.add_argument("paths", nargs="*", help="image files or directories to search for images")
+  parser.add_argument("--file-list", help="text file with one image path per line")
+  parser.add_argument("--model", required=True, help="path of a saved model")
+  parser.add_argument("--breeds", help="JSON with the model's breeds, defaults to the version JSON next to the model")
+  parser.add_argument("--labels", default=LABELS_PATH, help="labels.csv to take the breeds from if the model has no version JSON")
+  parser.add_argument("--output", default="predictions.jsonl", help="JSONL or CSV (picked by extension) output file")
+  parser.add_argument("--cache", default=PREDICTION_CACHE_PATH, help="SQLite prediction cache file")
+  parser.add_argument("--top-k", type=int, default=5, help="number of breeds to write per image")
+  parser.add_argument("--batch-size", type=int, default=PREDICT_BATCH_SIZE, help="largest batch to predict at once")
+  parser.add_argument("--img-size", type=int, default=PREDICT_IMG_SIZE, help="image size the photos are resized to")
+  parser.add_argument("--readers", type=int, default=8, help="number of images read at the same time")
+  args = parser.parse_args(argv)
+
+  paths = list(args.paths)
+  if args.file_list:
+    with open(args.file_list) as f:
+      paths += [line.strip() for line in f if line.strip()]
+  if not paths:
+    parser.error("no images given, pass image paths, directories or --file-list")
+
+  model = load_model(args.model)
+  breeds = load_model_breeds(args.model, args.breeds, args.labels)
+  if model.output_shape[-1] != len(breeds):
+    parser.error(f"the model predicts {model.output_shape[-1]} breeds but {len(breeds)} breeds were loaded, pass --breeds")
+  cache = create_prediction_cache(args.cache)
+  run = predict_files(model, paths,
+                      output_path=args.output,
+                      cache=cache,
+                      breeds=breeds,
+                      top_k=args.top_k,
+                      batch_size=args.batch_size,
+                      img_size=args.img_size,
+                      num_readers=args.readers)
+
+  # Colab already runs an event loop, so run the pipeline in its own thread there
+  try:
+    asyncio.get_running_loop()
+  except RuntimeError:
+    stats = asyncio.run(run)
+  else:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+      stats = executor.submit(asyncio.run, run).result()
+
+  report_cache_metrics(cache)
+  close_prediction_cache(cache)
+  return stats
+
+if __name__ == "__main__":
+  main()